@@ -1,32 +1,107 @@
 
-import cv2, os
+import cv2, io, os, threading
 import numpy as np
 import streamlit as st
 import matplotlib.pyplot as plt
-from PIL import Image, ImageEnhance
-
-@st.cache
-def load_image(img):
-    im = Image.open(img)
-    return im
+from PIL import Image
 
 FACE_CASCADE_PATH = './algos/haarcascade_frontalface_default.xml'
+# LBP features are integer comparisons, several times cheaper than Haar sums
+LBP_FACE_CASCADE_PATH = './algos/lbpcascade_frontalface_improved.xml'
+DETECTION_MAX_SIDE = 640
+MAX_IMAGE_SIZE = (1280, 1280)
+BLUR_MIN, BLUR_MAX, BLUR_STEP = 0.5, 3.5, 0.1
+# Cached images fit in MAX_IMAGE_SIZE (<= ~5 MB as RGB); every session shares them
+IMAGE_CACHE_MAX_ENTRIES = 8
+IMAGE_CACHE_TTL = 60 * 60
+# Below this many pixels the host<->device copies cost more than OpenCL saves
+OPENCL_MIN_PIXELS = 1024 * 1024
+
+cv2.setUseOptimized(True)
+# Thread the cascade's scale pyramid, leaving headroom for Streamlit's own threads
+cv2.setNumThreads(min(os.cpu_count() or 1, 8))
+cv2.ocl.setUseOpenCL(cv2.ocl.haveOpenCL())
 
-face_cascade = cv2.CascadeClassifier(FACE_CASCADE_PATH )
 # eye_cascade = cv2.CascadeClassifier('algos/haarcascade_eye.xml')
 # smile_cascade = cv2.CascadeClassifier('algos/haarcascade_smile.xml')
 
-def detect_faces(uploaded_image):
-    new_img = np.array(uploaded_image.convert('RGB'))
-    temp_img = cv2.cvtColor(new_img, 1)
-    gray = cv2.cvtColor(temp_img, cv2.COLOR_BGR2GRAY)
+@st.cache(max_entries=IMAGE_CACHE_MAX_ENTRIES, ttl=IMAGE_CACHE_TTL)
+def load_image(file_bytes):
+    im = Image.open(io.BytesIO(file_bytes))
+    if im.format not in ('JPEG', 'PNG'):
+        raise ValueError(f'Unsupported image format: {im.format}')
+    # Let libjpeg decode big photos at 1/2, 1/4 or 1/8 scale
+    im.draft('RGB', MAX_IMAGE_SIZE)
+    # Bound every format (PNGs are not drafted) so cache entries stay small
+    im.thumbnail(MAX_IMAGE_SIZE)
+    return np.asarray(im.convert('RGB'))
+
+@st.cache(allow_output_mutation=True)
+def get_detector():
+    # Streamlit reruns the script on every widget change; load the model once.
+    # Sessions run in their own threads and share this classifier, so it comes
+    # with a lock (a module-level lock would be recreated on every rerun).
+    detector = cv2.CascadeClassifier(LBP_FACE_CASCADE_PATH)
+    if detector.empty():
+        detector = cv2.CascadeClassifier(FACE_CASCADE_PATH)
+    return detector, threading.Lock()
+
+def detect_faces(rgb_img):
+    # Shrink large photos before running the cascade
+    small = rgb_img
+    scale = DETECTION_MAX_SIDE / max(rgb_img.shape[:2])
+    if scale < 1:
+        small = cv2.resize(rgb_img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    else:
+        scale = 1
+    gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
     # Detect Face
-    faces = face_cascade.detectMultiScale(gray, 1.1, 4)
-    # Draw Rectangle
+    detector, detector_lock = get_detector()
+    with detector_lock:
+        faces = detector.detectMultiScale(gray, 1.1, 4, minSize=(30,30))
+    if not len(faces):
+        return rgb_img, faces
+    faces = (faces / scale).astype(int)
+    # Draw Rectangle on a copy; rgb_img is shared through st.cache
+    new_img = rgb_img.copy()
     for (x,y,w,h) in faces:
-        cv2.rectangle(temp_img, (x,y), (x+w, y+h), (255,0,0), 2)
-
-    return temp_img, faces
+        cv2.rectangle(new_img, (x,y), (x+w, y+h), (255,0,0), 2)
+
+    return new_img, faces
+
+def to_device(img):
+    if cv2.ocl.useOpenCL() and img.shape[0] * img.shape[1] > OPENCL_MIN_PIXELS:
+        return cv2.UMat(img)
+    return img
+
+def from_device(img):
+    return img.get() if isinstance(img, cv2.UMat) else img
+
+@st.cache(allow_output_mutation=True)
+def gaussian_kernels():
+    # One 11-tap kernel per 0.1 step of the Blur slider
+    steps = int(round((BLUR_MAX - BLUR_MIN) / BLUR_STEP))
+    return [cv2.getGaussianKernel(11, BLUR_MIN + i * BLUR_STEP) for i in range(steps + 1)]
+
+@st.cache(allow_output_mutation=True, max_entries=IMAGE_CACHE_MAX_ENTRIES, ttl=IMAGE_CACHE_TTL)
+def blur_image(img, blur_rate):
+    # Separable Gaussian: two 1D passes instead of one 2D convolution
+    kernels = gaussian_kernels()
+    i = int(round((blur_rate - BLUR_MIN) / BLUR_STEP))
+    kernel = kernels[min(len(kernels) - 1, max(0, i))]
+    return from_device(cv2.sepFilter2D(to_device(img), -1, kernel, kernel))
+
+@st.cache(allow_output_mutation=True, max_entries=IMAGE_CACHE_MAX_ENTRIES, ttl=IMAGE_CACHE_TTL)
+def adjust_contrast(img, contrast_rate):
+    # Blend towards the mean gray level, like ImageEnhance.Contrast
+    r, g, b, _ = cv2.mean(img)
+    mean = 0.299 * r + 0.587 * g + 0.114 * b
+    return cv2.addWeighted(img, contrast_rate, img, 0, (1 - contrast_rate) * mean)
+
+@st.cache(allow_output_mutation=True, max_entries=IMAGE_CACHE_MAX_ENTRIES, ttl=IMAGE_CACHE_TTL)
+def adjust_brightness(img, brightness_rate):
+    # Scale towards black, like ImageEnhance.Brightness
+    return cv2.convertScaleAbs(img, alpha=brightness_rate)
 
 def main():
     '''
@@ -45,49 +120,40 @@ def main():
         image_file = st.file_uploader('Upload Image', type=['jpg', 'png', 'jpeg'])
 
         if image_file is not None:
-            uploaded = Image.open(image_file)
-            # st.write(type(uploaded))
+            rgb_img = load_image(image_file.getvalue())
+            # st.write(type(rgb_img))
             st.text('Original Image')
-            st.image(uploaded)
+            st.image(rgb_img)
 
         enhance_type = st.sidebar.radio('Enhance Type', ['Original', 'Grayscale', 'Contrast', 'Brightness', 'Blur'])
 
         if enhance_type == 'Grayscale':
-            new_img = np.array(uploaded.convert('RGB'))
-            temp_img = cv2.cvtColor(new_img, 1)
-            gray = cv2.cvtColor(temp_img, cv2.COLOR_BGR2GRAY)
+            gray = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2GRAY)
             st.image(gray)
-            # Print on screen
-            st.write(gray)
-            st.write(new_img)
 
         if enhance_type == 'Contrast':
-            contrast_rate = st.sidebar.slider('Contrtast', 0.5, 3.5)
-            enhancer = ImageEnhance.Contrast(uploaded)
-            img_output = enhancer.enhance(contrast_rate)
+            contrast_rate = st.sidebar.slider('Contrtast', 0.5, 3.5, step=0.1)
+            img_output = adjust_contrast(rgb_img, round(contrast_rate, 1))
             st.image(img_output)
 
         if enhance_type == 'Brightness':
-            contrast_rate = st.sidebar.slider('Brigthness', 0.5, 3.5)
-            enhancer = ImageEnhance.Brightness(uploaded)
-            img_output = enhancer.enhance(contrast_rate)
+            contrast_rate = st.sidebar.slider('Brigthness', 0.5, 3.5, step=0.1)
+            img_output = adjust_brightness(rgb_img, round(contrast_rate, 1))
             st.image(img_output)
 
         if enhance_type == 'Blur':
-            blur_rate = st.sidebar.slider('Blur', 0.5, 3.5)
-            new_img = np.array(uploaded.convert('RGB'))
-            temp_img = cv2.cvtColor(new_img, 1)
-            blurred = cv2.GaussianBlur(temp_img, (11,11), blur_rate)
+            blur_rate = st.sidebar.slider('Blur', BLUR_MIN, BLUR_MAX, step=BLUR_STEP)
+            blurred = blur_image(rgb_img, round(blur_rate, 1))
             st.image(blurred)
         # else:
-        #     st.image(uploaded)
+        #     st.image(rgb_img)
 
         # Face Detection
         target = ['Faces', 'Smiles', 'Eyes']
         feature_choice = st.sidebar.selectbox('Find Features', target)
         if st.button('Detect Faces'):
             if feature_choice == 'Faces':
-                result_img, result_faces = detect_faces(uploaded)
+                result_img, result_faces = detect_faces(rgb_img)
                 st.image(result_img)
 
                 st.success(f'Found {len(result_faces)} faces.')